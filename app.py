@@ -1,9 +1,36 @@
+import asyncio
+import base64
+import csv
+import gzip
+import hashlib
 import io
 import json
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
 import streamlit as st
-from xml.etree import ElementTree as ET
 import re
+import threading
+import time
+from concurrent.futures import as_completed
+from pathlib import Path
+
+try:
+    import lxml.etree as ET  # libxml2-backed; same findall/namespace API as the stdlib
+    HAS_LXML = True
+except ImportError:
+    from xml.etree import ElementTree as ET
+    HAS_LXML = False
+
+try:
+    import orjson  # Rust encoder/decoder; much faster than json on multi-MB strings
+
+    def js_literal(value) -> str:
+        return orjson.dumps(value).decode("utf-8")
+    json_loads = orjson.loads
+except ImportError:
+    js_literal = json.dumps
+    json_loads = json.loads
 
 # ---------- Page ----------
 st.set_page_config(page_title="BPMN → Extensions Generator", page_icon="🧩", layout="wide")
@@ -42,42 +69,339 @@ with st.sidebar:
         st.caption("Add `OPENAI_API_KEY` in **Secrets** (App → Settings → Secrets) to enable the generators.")
 
 # ---------- Helpers ----------
+# The cached helpers below are keyed on a digest of the upload computed once per
+# run; arguments with a leading underscore are not hashed by st.cache_data.
 NS = {"bpmn": "http://www.omg.org/spec/BPMN/20100524/MODEL"}
-
-def parse_named_tasks(bpmn_xml: str):
-    root = ET.fromstring(bpmn_xml.encode("utf-8"))
-    out = []
-    for el in root.findall(".//bpmn:task", NS):
-        tid = el.attrib.get("id", "")
-        name = el.attrib.get("name") or el.attrib.get("{http://www.omg.org/spec/BPMN/20100524/MODEL}name", "")
-        if name:
-            out.append({"element_id": tid, "element_name": name})
-    seen, tasks = set(), []
-    for r in out:
-        if r["element_id"] not in seen:
-            tasks.append(r); seen.add(r["element_id"])
-    return tasks
+TASK_TAG = f"{{{NS['bpmn']}}}task"  # Clark notation, compared directly against el.tag
+# Top-level sections cleared as they close when lxml does the tag filtering.
+SECTION_TAGS = (f"{{{NS['bpmn']}}}process", "{http://www.omg.org/spec/BPMN/20100524/DI}BPMNDiagram")
+
+def _iter_named_tasks(bpmn_bytes: bytes):
+    # Stream the document and drop elements once they're closed, so DI-heavy
+    # exports don't have to be held in memory as a full tree. Under lxml the tag
+    # filter runs in C: Python only sees tasks and the process/diagram sections,
+    # and clearing a section frees its whole subtree at once.
+    src = io.BytesIO(bpmn_bytes)
+    if HAS_LXML:
+        events = ET.iterparse(src, events=("end",), tag=(TASK_TAG, *SECTION_TAGS))
+    else:
+        events = ET.iterparse(src, events=("end",))
+    names_by_id: dict[str, str] = {}  # insertion-ordered, first occurrence wins
+    for _, el in events:
+        if el.tag == TASK_TAG:
+            tid = el.get("id", "")
+            name = el.get("name")
+            if name and tid not in names_by_id:
+                names_by_id[tid] = name
+        el.clear()
+        if HAS_LXML:  # also release already-seen siblings
+            while el.getprevious() is not None:
+                del el.getparent()[0]
+    # Two parallel lists (ids, names) rather than one dict per task.
+    return list(names_by_id), list(names_by_id.values())
+
+# Raises ET.ParseError (lxml's XMLSyntaxError is a subclass) for malformed XML.
+@st.cache_data(show_spinner=False)
+def parse_named_tasks(bpmn_digest: str, _bpmn_bytes: bytes):
+    try:
+        return _iter_named_tasks(_bpmn_bytes)
+    except ET.ParseError:
+        # Exports with undeclared non-UTF-8 bytes: drop those bytes and retry.
+        return _iter_named_tasks(_bpmn_bytes.decode("utf-8", errors="ignore").encode("utf-8"))
+
+# Leading ```csv fence, trailing ``` fence, or any stray backtick, in one pass.
+_FENCE_RE = re.compile(r"^```(?:csv|CSV)?\s*|\s*```$|`")
 
 def clean_csv_text(raw: str) -> str:
-    txt = (raw or "").strip()
-    txt = re.sub(r"^```(?:csv|CSV)?\s*", "", txt)
-    txt = re.sub(r"\s*```$", "", txt)
-    txt = txt.replace("`", "")
-    return txt.strip()
-
-def call_openai_rows(model, api_key, prompt, temperature=0.2):
+    return _FENCE_RE.sub("", (raw or "").strip()).strip()
+
+def read_csv_text(csv_text: str, columns: list) -> pd.DataFrame:
+    # Model responses are a few KB at most: the csv module plus one record-based
+    # constructor beats a full read_csv, and every cell stays a string (the
+    # columns are cast/stripped downstream anyway). Unknown columns are dropped.
+    # Like read_csv, raise on output that isn't the requested table at all.
+    reader = csv.DictReader(io.StringIO(csv_text), skipinitialspace=True)
+    rows = list(reader)
+    if not set(reader.fieldnames or ()) & set(columns):
+        header = (csv_text or "").partition("\n")[0][:80]
+        raise ValueError(f"header has none of the expected columns: {header!r}")
+    if not rows:
+        raise ValueError("no data rows")
+    return pd.DataFrame.from_records(rows, columns=columns)
+
+# One client (and its httpx connection pool) per key, shared across reruns and tabs.
+@st.cache_resource(show_spinner=False)
+def _client(api_key: str):
     from openai import OpenAI
-    client = OpenAI(api_key=api_key)
+    return OpenAI(api_key=api_key)
+
+# Completed responses, keyed on a digest of everything that shapes the output.
+# Stored on disk so they survive restarts: in diskcache when it is installed,
+# otherwise in a small JSON file; entries older than RESPONSE_TTL are ignored.
+RESPONSE_TTL = 24 * 3600
+RESPONSE_CACHE_DIR = Path.home() / ".cache" / "bpmn-ext"
+
+class _JsonResponseCache(dict):
+    # Mirrors the diskcache calls used below. Rewritten on every store, after
+    # dropping expired entries; responses are a few KB and stores are rare.
+    def __init__(self, path: Path):
+        self._path, self._lock = path, threading.Lock()
+        try:
+            super().__init__(json_loads(path.read_bytes()))
+        except (OSError, ValueError):
+            super().__init__()
+
+    def set(self, key, value, expire):
+        with self._lock:
+            now = time.time()
+            for stale in [k for k, (stored_at, _) in self.items() if now - stored_at >= expire]:
+                del self[stale]
+            self[key] = value
+            try:
+                self._path.parent.mkdir(parents=True, exist_ok=True)
+                tmp = self._path.with_suffix(".part")
+                tmp.write_text(json.dumps(self), encoding="utf-8")
+                tmp.replace(self._path)
+            except OSError:
+                pass  # read-only home: keep the entry in memory only
+
+@st.cache_resource(show_spinner=False)
+def _response_cache():
+    try:
+        import diskcache
+    except ImportError:
+        return _JsonResponseCache(RESPONSE_CACHE_DIR / "responses.json")
+    return diskcache.Cache(str(RESPONSE_CACHE_DIR))
+
+def response_key(*parts) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        h.update(str(part).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+def cached_response(key: str):
+    hit = _response_cache().get(key)
+    if hit is not None and time.time() - hit[0] < RESPONSE_TTL:
+        return hit[1]
+    return None
+
+def store_response(key: str, text: str):
+    _response_cache().set(key, (time.time(), text), expire=RESPONSE_TTL)
+
+def parse_csv_lines(lines) -> list:
+    # Complete lines from a streamed response; code-fence lines are dropped.
+    return list(csv.reader(l for l in lines if l.strip() and not l.lstrip().startswith("```")))
+
+def preview_rows(placeholder, rows: list):
+    try:
+        placeholder.dataframe(pd.DataFrame(rows[1:], columns=rows[0]), use_container_width=True)
+    except Exception:
+        pass  # ragged row mid-stream; the next update will catch up
+
+# The tables are structured data, not prose: calls default to temperature 0 with
+# a fixed seed so the same prompt gives (as far as OpenAI allows) the same
+# table, which keeps cached responses representative.
+SEED = 42
+
+def chat_messages(prompt, system=None):
+    # A shared system prefix lets OpenAI's automatic prompt cache kick in across calls.
+    head = [{"role":"system","content":system}] if system else []
+    return head + [{"role":"user","content":prompt}]
+
+# accept(csv_text), if given, turns the response into a stored table and raises
+# when it can't; only accepted responses are cached.
+def call_openai_rows(model, api_key, prompt, temperature=0, preview=None, preview_every=5, system=None,
+                     refresh=False, accept=None):
+    key = response_key("rows", model, temperature, SEED, system, prompt)
+    hit = None if refresh else cached_response(key)
+    if hit is not None:
+        if accept is not None:
+            accept(hit)
+        return hit
+    client = _client(api_key)
+    stream = client.chat.completions.create(
+        model=model,
+        messages=chat_messages(prompt, system),
+        temperature=temperature,
+        seed=SEED,
+        stream=True,
+    )
+    # Each complete line is parsed once as it arrives, so the preview grows
+    # without re-reading the whole buffer.
+    buf, tail, rows, shown = [], "", [], 0
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        piece = chunk.choices[0].delta.content or ""
+        buf.append(piece)
+        if preview is None:
+            continue
+        tail += piece
+        if "\n" not in piece:
+            continue
+        *lines, tail = tail.split("\n")
+        rows.extend(parse_csv_lines(lines))
+        if len(rows) - shown >= preview_every:
+            shown = len(rows)
+            preview_rows(preview, rows)
+    if preview is not None:
+        preview.empty()
+    text = clean_csv_text("".join(buf))
+    if accept is not None:
+        accept(text)
+    store_response(key, text)
+    return text
+
+# The async client is bound to the event loop it first runs on, so both live for
+# the whole process: one loop on a daemon thread, one client per key on it.
+@st.cache_resource(show_spinner=False)
+def _event_loop():
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="openai-loop", daemon=True).start()
+    return loop
+
+@st.cache_resource(show_spinner=False)
+def _async_client(api_key: str):
+    from openai import AsyncOpenAI
+    # Up to 3 attempts: the SDK retries rate limits, 5xx and connection errors
+    # with exponential backoff.
+    return AsyncOpenAI(api_key=api_key, max_retries=2)
+
+# Issues the prompts concurrently; returns {name: csv_text or the raised Exception}.
+# on_done(name), if given, is called (on the script thread) as each request
+# finishes; accept(name, csv_text) works as in call_openai_rows.
+def call_openai_rows_parallel(model, api_key, prompts: dict, temperature=0, on_done=None, system=None,
+                              refresh=False, accept=None):
+    client = _async_client(api_key)
+
+    async def _one(prompt):
+        resp = await client.chat.completions.create(
+            model=model,
+            messages=chat_messages(prompt, system),
+            temperature=temperature,
+            seed=SEED,
+        )
+        return clean_csv_text(resp.choices[0].message.content)
+
+    # Cache lookups and writes stay on the script thread; only the requests run
+    # on the loop.
+    results, futures = {}, {}
+    loop = _event_loop()
+    for name, prompt in prompts.items():
+        key = response_key("rows", model, temperature, SEED, system, prompt)
+        hit = None if refresh else cached_response(key)
+        if hit is not None:
+            try:
+                if accept is not None:
+                    accept(name, hit)
+                results[name] = hit
+            except Exception as e:
+                results[name] = e
+            if on_done is not None:
+                on_done(name)
+        else:
+            futures[asyncio.run_coroutine_threadsafe(_one(prompt), loop)] = (name, key)
+    for fut in as_completed(futures):
+        name, key = futures[fut]
+        try:
+            text = fut.result()
+            if accept is not None:
+                accept(name, text)
+            results[name] = text
+            store_response(key, text)
+        except Exception as e:
+            results[name] = e
+        if on_done is not None:
+            on_done(name)
+    return {k: results[k] for k in prompts}
+
+# OpenAI Batch API: half the token price, results within the completion window.
+def submit_batch(model, api_key, prompts: dict, temperature=0, system=None) -> str:
+    lines = (
+        json.dumps({"custom_id": name, "method": "POST", "url": "/v1/chat/completions",
+                    "body": {"model": model, "messages": chat_messages(prompt, system),
+                             "temperature": temperature, "seed": SEED}})
+        for name, prompt in prompts.items()
+    )
+    client = _client(api_key)
+    upload = client.files.create(file=("tables.jsonl", "\n".join(lines).encode("utf-8")), purpose="batch")
+    batch = client.batches.create(input_file_id=upload.id, endpoint="/v1/chat/completions",
+                                  completion_window="24h")
+    return batch.id
+
+BATCH_DONE = ("completed", "failed", "expired", "cancelled")
+
+# Returns (status, {name: csv_text or Exception}); results stay empty until the
+# batch has finished, then cover every requested name.
+def fetch_batch(api_key, batch_id, names):
+    client = _client(api_key)
+    batch = client.batches.retrieve(batch_id)
+    if batch.status not in BATCH_DONE:
+        return batch.status, {}
+    # Successful requests land in the output file, failed ones in the error
+    # file; either may be missing (e.g. when every request failed).
+    results = {}
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        for line in client.files.content(file_id).text.splitlines():
+            if not line.strip():
+                continue
+            rec = json_loads(line)
+            resp = rec.get("response") or {}
+            if rec.get("error") or resp.get("status_code") != 200:
+                results[rec["custom_id"]] = RuntimeError(rec.get("error") or resp.get("body"))
+            else:
+                results[rec["custom_id"]] = clean_csv_text(resp["body"]["choices"][0]["message"]["content"])
+    return batch.status, {
+        name: results.get(name, RuntimeError(f"no result returned (batch {batch.status})")) for name in names
+    }
+
+def rows_schema(columns) -> dict:
+    # Strict structured-output schema for an array of rows; every cell is a string.
+    return {
+        "type": "array",
+        "items": {
+            "type": "object",
+            "properties": {c: {"type": "string"} for c in columns},
+            "required": list(columns),
+            "additionalProperties": False,
+        },
+    }
+
+def call_openai_json(model, api_key, prompt, temperature=0, schema=None, system=None, refresh=False):
+    key = response_key("json", model, temperature, SEED, system, prompt, json.dumps(schema, sort_keys=True))
+    hit = None if refresh else cached_response(key)
+    if hit is not None:
+        return json_loads(hit)
+    client = _client(api_key)
+    if schema is None:
+        response_format = {"type":"json_object"}
+    else:
+        response_format = {"type":"json_schema",
+                           "json_schema":{"name":"tables", "strict":True, "schema":schema}}
     resp = client.chat.completions.create(
         model=model,
-        messages=[{"role":"user","content":prompt}],
+        messages=chat_messages(prompt, system),
         temperature=temperature,
+        seed=SEED,
+        response_format=response_format,
     )
-    return clean_csv_text(resp.choices[0].message.content)
+    text = resp.choices[0].message.content
+    data = json_loads(text)  # only cache payloads that parse
+    store_response(key, text)
+    return data
 
-def df_download_button(df: pd.DataFrame, label: str, filename: str):
-    st.download_button(label, df.to_csv(index=False).encode("utf-8"),
-                       file_name=filename, mime="text/csv")
+# download_button takes its data on every rerun; each table is serialized once,
+# with Arrow's C++ CSV writer, when it is stored (see store_table).
+def df_to_csv_bytes(df: pd.DataFrame) -> bytes:
+    buf = pa.BufferOutputStream()
+    pacsv.write_csv(pa.Table.from_pandas(df, preserve_index=False), buf)
+    return buf.getvalue().to_pybytes()
+
+def df_download_button(data: bytes, label: str, filename: str):
+    st.download_button(label, data, file_name=filename, mime="text/csv")
 
 def require_key():
     if not OPENAI_API_KEY:
@@ -90,36 +414,52 @@ def show_table_with_download(state_key: str, columns: list, filename: str):
     if df is None:
         st.dataframe(pd.DataFrame(columns=columns), use_container_width=True)
     else:
-        cols = [c for c in columns if c in df.columns]
-        st.dataframe(df[cols] if cols else df, use_container_width=True)
-        df_download_button(df[cols] if cols else df, f"⬇️ Download {filename}", filename)
-
-def tasks_bullets(tasks):
-    return "\n".join(f"- {t['element_name']} (id: {t['element_id']})" for t in tasks) or "- (none)"
-
-def build_task_maps(tasks):
-    id_to_name = {t["element_id"]: t["element_name"] for t in tasks}
-    valid_ids = set(id_to_name.keys())
-    valid_names = set(id_to_name.values())
-    name_to_id = {v: k for k, v in id_to_name.items()}
+        st.dataframe(df, use_container_width=True)
+        df_download_button(st.session_state[f"{state_key}_csv"], f"⬇️ Download {filename}", filename)
+
+# The mapping is embedded in every prompt; build it once per upload, not per rerun.
+@st.cache_data(show_spinner=False)
+def tasks_mapping_lines(bpmn_digest: str, _task_ids, _task_names):
+    return "\n".join(f"{i},{n}" for i, n in zip(_task_ids, _task_names))
+
+def build_task_maps(task_ids, task_names):
+    id_to_name = dict(zip(task_ids, task_names))
+    valid_ids = set(task_ids)
+    valid_names = set(task_names)
+    name_to_id = dict(zip(task_names, task_ids))
     return id_to_name, name_to_id, valid_ids, valid_names
 
-def align_to_tasks(df: pd.DataFrame, tasks):
+def align_to_tasks(df: pd.DataFrame, task_ids, task_names):
     if not {"element_id", "element_name"}.issubset(df.columns):
         return df
-    id_to_name, name_to_id, valid_ids, valid_names = build_task_maps(tasks)
-    df = df.copy()
-    df["element_id"] = df["element_id"].astype(str).str.strip()
-    df["element_name"] = df["element_name"].astype(str).str.strip()
-    mask_swap = df["element_id"].isin(valid_names) & df["element_name"].isin(valid_ids)
-    df.loc[mask_swap, ["element_id", "element_name"]] = df.loc[mask_swap, ["element_name", "element_id"]].values
-    mask_move = ~df["element_id"].isin(valid_ids) & df["element_name"].isin(valid_ids)
-    df.loc[mask_move, "element_id"] = df.loc[mask_move, "element_name"]
-    mask_from_name = ~df["element_id"].isin(valid_ids) & df["element_name"].isin(valid_names)
-    df.loc[mask_from_name, "element_id"] = df.loc[mask_from_name, "element_name"].map(name_to_id)
-    df = df[df["element_id"].isin(valid_ids)].copy()
-    df["element_name"] = df["element_id"].map(id_to_name)
-    return df.reset_index(drop=True)
+    id_to_name, name_to_id, valid_ids, valid_names = build_task_maps(task_ids, task_names)
+    # Fast path: the model usually copies the mapping exactly, so skip the repair.
+    if df["element_id"].isin(valid_ids).all() and df["element_name"].eq(df["element_id"].map(id_to_name)).all():
+        return df.reset_index(drop=True)
+    ids = df["element_id"].astype(str).str.strip()
+    names = df["element_name"].astype(str).str.strip()
+    # Undo swapped id/name columns, then let an id-or-name in element_name stand
+    # in for an unknown element_id.
+    swap = ids.isin(valid_names) & names.isin(valid_ids)
+    ids, names = ids.where(~swap, names), names.where(~swap, ids)
+    fallback = names.where(names.isin(valid_ids), names.map(name_to_id))
+    ids = ids.where(ids.isin(valid_ids), fallback)
+    # One inner join drops rows that still don't resolve and restores the
+    # canonical task names.
+    canon = pd.DataFrame({"element_id": task_ids, "element_name": task_names})
+    out = df.drop(columns="element_name").assign(element_id=ids).merge(canon, on="element_id", how="inner")
+    return out[list(df.columns)]
+
+def add_risk_scores(df: pd.DataFrame) -> pd.DataFrame:
+    if not {"likelihood_1to5", "impact_1to5"}.issubset(df.columns):
+        return df
+    # A few hundred 1-5 integers at most: one vectorised product is all it takes.
+    # Blank, non-numeric or out-of-range ratings stay missing (and so does the
+    # score) rather than reading as "no risk".
+    def _col(c):
+        v = pd.to_numeric(df[c], errors="coerce")
+        return v.where(v.between(1, 5) & (v % 1 == 0)).astype("Int16")
+    return df.assign(risk_score=_col("likelihood_1to5") * _col("impact_1to5"))
 
 # ---------- Upload ----------
 st.title("BPMN → Extensions Generator")
@@ -177,38 +517,62 @@ sample_exp = st.expander("Need a tiny sample?")
 with sample_exp:
     st.code(SAMPLE_XML, language="xml")
 
-# 4) Decide the BPMN source:
-bpmn_xml = None
+# 4) Decide the BPMN source (kept as bytes; the parser reads them directly):
+bpmn_bytes = None
 if st.session_state.get("use_sample"):
-    bpmn_xml = SAMPLE_XML
+    bpmn_bytes = SAMPLE_XML.encode("utf-8")
 elif uploaded is not None:
-    bpmn_xml = uploaded.read().decode("utf-8", errors="ignore")
+    bpmn_bytes = uploaded.getvalue()
 
-if not bpmn_xml:
+if not bpmn_bytes:
     st.info("Upload a BPMN file to proceed, or click **Load tiny sample**.")
     st.stop()
 
-tasks = parse_named_tasks(bpmn_xml)
+bpmn_digest = hashlib.sha1(bpmn_bytes).hexdigest()
+try:
+    task_ids, task_names = parse_named_tasks(bpmn_digest, bpmn_bytes)
+except ET.ParseError as e:
+    st.error(f"Could not parse the BPMN file: {e}")
+    st.stop()
 
 # ---------- Render Diagram ----------
-st.subheader("Process Diagram")
-bpmn_html = f"""
+# Pinned bpmn-js bundles, loaded straight from unpkg. (Streamlit's static
+# serving sends .js files as text/plain with nosniff, so browsers won't run
+# locally served copies.)
+VIEWER_SCRIPTS = (
+    "https://unpkg.com/bpmn-js@10.2.1/dist/bpmn-viewer.production.min.js",
+    "https://unpkg.com/bpmn-moddle@7.1.3/dist/bpmn-moddle.umd.js",
+    "https://unpkg.com/bpmn-auto-layout@0.7.0/dist/bpmn-auto-layout.umd.js",
+)
+VIEWER_SCRIPT_TAGS = "\n".join(f'<script src="{url}"></script>' for url in VIEWER_SCRIPTS)
+
+# Built once per unique upload (and set of script tags, which is hashed with
+# it); reruns reuse the cached string.
+@st.cache_data(show_spinner=False)
+def build_render_html(bpmn_digest: str, _bpmn_bytes: bytes, script_tags: str) -> str:
+    # Ship the XML to the iframe gzipped + base64 (BPMN compresses ~6-10x); the
+    # browser inflates it with the native DecompressionStream.
+    bpmn_payload = base64.b64encode(gzip.compress(_bpmn_bytes, compresslevel=6, mtime=0)).decode("ascii")
+    return f"""
 <div id="canvas" style="height:65vh;border:1px solid #ddd;border-radius:8px;"></div>
-<script src="https://unpkg.com/bpmn-js@10.2.1/dist/bpmn-viewer.production.min.js"></script>
-<script src="https://unpkg.com/bpmn-moddle@7.1.3/dist/bpmn-moddle.umd.js"></script>
-<script src="https://cdn.jsdelivr.net/npm/bpmn-auto-layout@0.7.0/dist/bpmn-auto-layout.umd.js"></script>
-<script src="https://unpkg.com/bpmn-auto-layout@0.7.0/dist/bpmn-auto-layout.umd.js"></script>
+{script_tags}
 <script>
-  const xmlIn = {json.dumps(bpmn_xml)};
+  const payload = {js_literal(bpmn_payload)};
+  async function inflateXml(b64) {{
+    const bytes = Uint8Array.from(atob(b64), c => c.charCodeAt(0));
+    const stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream('gzip'));
+    return await new Response(stream).text();
+  }}
   const viewer = new BpmnJS({{ container: '#canvas' }});
   const ModdleCtor =
     (window.BpmnModdle && (window.BpmnModdle.BpmnModdle || window.BpmnModdle.default || window.BpmnModdle)) || null;
   const autoLayoutFn =
     (window.BpmnAutoLayout && (window.BpmnAutoLayout.layout || window.BpmnAutoLayout)) ||
     (window.bpmnAutoLayout && (window.bpmnAutoLayout.layout || window.bpmnAutoLayout)) || null;
-  const hasDI = /<\\s*bpmndi:BPMNDiagram[\\s>]/.test(xmlIn);
   (async () => {{
     try {{
+      const xmlIn = await inflateXml(payload);
+      const hasDI = /<\\s*bpmndi:BPMNDiagram[\\s>]/.test(xmlIn);
       if (hasDI) {{
         await viewer.importXML(xmlIn);
       }} else {{
@@ -230,12 +594,19 @@ bpmn_html = f"""
   }})();
 </script>
 """
+
+st.subheader("Process Diagram")
+# The iframe is emitted on every run (skipping it would drop it from the page),
+# but Streamlit keeps the existing frame when the HTML is unchanged, so a
+# byte-identical string per upload (cached, gzip mtime=0) avoids bpmn-js
+# re-importing the diagram on reruns.
+bpmn_html = build_render_html(bpmn_digest, bpmn_bytes, VIEWER_SCRIPT_TAGS)
 st.components.v1.html(bpmn_html, height=520, scrolling=True)
 
 # ---------- Tasks ----------
 st.subheader("Detected Tasks")
-if tasks:
-    st.dataframe(pd.DataFrame(tasks), use_container_width=True)
+if task_ids:
+    st.dataframe(pd.DataFrame({"element_id": task_ids, "element_name": task_names}), use_container_width=True)
 else:
     st.warning("No named <bpmn:task> elements found. Add task names for better AI outputs.")
 
@@ -245,116 +616,281 @@ st.markdown("---")
 for _key in ["kpis", "risks", "raci", "controls"]:
     st.session_state.setdefault(_key, None)
 
-tabs = st.tabs(["KPIs", "Risks", "RACI", "Controls"])
-mapping_lines = "\n".join(f"{t['element_id']},{t['element_name']}" for t in tasks)
+# Column legend for every table. It opens the shared system prefix: being
+# constant, it makes that prefix identical across tabs, reruns and uploads, and
+# long enough to clear OpenAI's 1024-token minimum for automatic prompt caching.
+COLUMN_LEGEND = """Column legend (applies to every table you are asked for):
+- element_id: the BPMN task id, copied verbatim from the task mapping. Never invent, renumber, abbreviate or translate ids.
+- element_name: the task name paired with that id in the task mapping, copied verbatim.
+
+KPI table
+- kpi_key: short snake_case identifier for the measure, e.g. cycle_time_hours, first_pass_yield_pct, backlog_count. Unique per task.
+- current_value: the present level of the measure. A plain number, or a percentage such as 87%. No units beyond %; put units in kpi_key.
+- target_value: the level the process owner aims for, in the same unit and format as current_value.
+- owner: the role accountable for the KPI (e.g. Process Owner, Finance Manager), not a person's name.
+- last_updated: date the value was last measured, formatted YYYY-MM-DD.
+
+Risk register
+- risk_description: one sentence describing what could go wrong in the task and its consequence. Avoid commas where possible; quote the field if a comma is needed.
+- risk_category: one of Operational, Financial, Compliance, Strategic, Technology, Reputational.
+- likelihood_1to5: integer 1 (rare) to 5 (almost certain).
+- impact_1to5: integer 1 (negligible) to 5 (severe).
+- mitigation_owner: role responsible for treating the risk.
+- control_ref: identifier of the control that mitigates the risk (e.g. CTRL-001), or empty if none exists yet.
+
+RACI matrix
+- role: a business role or team participating in the task (e.g. Requester, Approver, Finance, IT Support).
+- responsibility_type: exactly one letter: R (Responsible: does the work), A (Accountable: signs off; one per task), C (Consulted: gives input before), I (Informed: told after).
+
+Controls
+- control_name: short imperative name for the control (e.g. Dual approval above threshold).
+- control_type: Preventive, Detective or Corrective.
+- frequency: per_txn, daily, weekly or monthly.
+- evidence_required: the artefact an auditor would inspect to confirm the control ran (e.g. approval log, reconciliation report).
+- owner: role that operates the control.
+
+General rules for CSV output
+- Emit one header row with the columns in exactly the order requested, then data rows.
+- Cover every task in the mapping at least once unless a task genuinely has nothing to add.
+- Keep values concise: single line, no line breaks inside a field, no markdown.
+- Use a comma as the separator and double quotes around any field that itself contains a comma or a quote character.
+- Do not add commentary, explanations, numbering or totals before or after the table.
+- Use British or American spelling consistently within one table.
+- Prefer concrete, measurable wording over generic statements such as "improve efficiency".
+
+Example rows (format only; use the real tasks from the mapping, not these)
+KPI table:
+element_id,element_name,kpi_key,current_value,target_value,owner,last_updated
+Task_Review,Review Invoice,review_cycle_time_hours,36,24,Accounts Payable Lead,2024-05-31
+Task_Review,Review Invoice,first_pass_match_pct,82%,95%,Accounts Payable Lead,2024-05-31
+Risk register:
+element_id,element_name,risk_description,risk_category,likelihood_1to5,impact_1to5,mitigation_owner,control_ref
+Task_Review,Review Invoice,Duplicate invoice paid because the duplicate check is skipped,Financial,3,4,Accounts Payable Lead,CTRL-004
+RACI matrix:
+element_id,element_name,role,responsibility_type
+Task_Review,Review Invoice,Accounts Payable Clerk,R
+Task_Review,Review Invoice,Accounts Payable Lead,A
+Task_Review,Review Invoice,Procurement,C
+Controls:
+element_id,element_name,control_name,control_type,frequency,evidence_required,owner
+Task_Review,Review Invoice,Three-way match before approval,Preventive,per_txn,Matched PO/receipt/invoice record,Accounts Payable Lead
+Task_Review,Review Invoice,Weekly duplicate payment scan,Detective,weekly,Duplicate scan report with sign-off,Finance Controller"""
+
+kpi_cols = ["element_id","element_name","kpi_key","current_value","target_value","owner","last_updated"]
+risk_cols = ["element_id","element_name","risk_description","risk_category","likelihood_1to5","impact_1to5","mitigation_owner","control_ref"]
+raci_cols = ["element_id","element_name","role","responsibility_type"]
+ctrl_cols = ["element_id","element_name","control_name","control_type","frequency","evidence_required","owner"]
+table_cols = {"kpis": kpi_cols, "risks": risk_cols, "raci": raci_cols, "controls": ctrl_cols}
+display_cols = {**table_cols, "risks": risk_cols + ["risk_score"]}
+mapping_lines = tasks_mapping_lines(bpmn_digest, task_ids, task_names)
+
+# Everything shared goes first, as the system message, so it forms a stable
+# cacheable prefix (constant legend, then this upload's task mapping); each
+# prompt below only carries its table-specific tail, which doesn't depend on
+# the upload. The prefix is the only per-upload string, so it is built once.
+@st.cache_data(show_spinner=False)
+def build_prompt_prefix(bpmn_digest: str, _mapping_lines: str) -> str:
+    return f"""You produce tabular BPM extension data (KPIs, risks, RACI, controls) for process tasks.
+
+{COLUMN_LEGEND}
+
+Task mapping. Use exactly these task identifiers and names (do not invent or renumber):
+element_id,element_name
+{_mapping_lines}"""
 
-# KPIs
-with tabs[0]:
-    st.markdown("Generate **KPI** rows for each task.")
-    kpi_cols = ["element_id","element_name","kpi_key","current_value","target_value","owner","last_updated"]
-    if st.button("Generate KPIs"):
-        key = require_key()
-        prompt = f"""You are a BPM KPI designer.
+prompt_prefix = build_prompt_prefix(bpmn_digest, mapping_lines)
 
-Use exactly these task identifiers and names (do not invent or renumber):
-element_id,element_name
-{mapping_lines}
+prompts = {
+    "kpis": f"""You are a BPM KPI designer.
 
 Create a CSV with columns (in this exact order):
 {", ".join(kpi_cols)}
 - Use snake_case for kpi_key.
 - current_value/target_value numeric or % where sensible.
 - last_updated: YYYY-MM-DD.
-Return only clean CSV (no code fences)."""
-        try:
-            csv_text = call_openai_rows(MODEL, key, prompt)
-            df = pd.read_csv(io.StringIO(csv_text))
-            df = align_to_tasks(df, tasks)
-            st.session_state["kpis"] = df
-        except Exception as e:
-            st.error(f"CSV parsing failed: {e}")
-    show_table_with_download("kpis", kpi_cols, "kpis.csv")
-
-# Risks
-with tabs[1]:
-    st.markdown("Generate **Risk Register** rows linked to tasks.")
-    risk_cols = ["element_id","element_name","risk_description","risk_category","likelihood_1to5","impact_1to5","mitigation_owner","control_ref"]
-    if st.button("Generate Risks"):
-        key = require_key()
-        prompt = f"""You are a risk analyst.
-
-Use exactly these task identifiers and names (do not invent or renumber):
-element_id,element_name
-{mapping_lines}
+Return only clean CSV (no code fences).""",
+    "risks": f"""You are a risk analyst.
 
 Create a CSV with columns (in this exact order):
 {", ".join(risk_cols)}
 Ensure comma-separated values and a single header row.
-Return pure CSV — no code fences."""
-        try:
-            csv_text = call_openai_rows(MODEL, key, prompt)
-            df = pd.read_csv(io.StringIO(csv_text))
-            df = align_to_tasks(df, tasks)
-            st.session_state["risks"] = df
-        except Exception as e:
-            st.error(f"CSV parsing failed: {e}")
-    show_table_with_download("risks", risk_cols, "risks.csv")
-
-# RACI
-with tabs[2]:
-    st.markdown("Generate **RACI** matrix entries per task.")
-    raci_cols = ["element_id","element_name","role","responsibility_type"]
-    if st.button("Generate RACI"):
-        key = require_key()
-        prompt = f"""For the following process tasks use the exact ids and names below.
-Do not invent or renumber.
-
-element_id,element_name
-{mapping_lines}
-
-Generate a CSV table. Columns (in order): {", ".join(raci_cols)}.
+Return pure CSV — no code fences.""",
+    "raci": f"""Generate a CSV table. Columns (in order): {", ".join(raci_cols)}.
 Create 1–3 rows per task, responsibility_type ∈ [R, A, C, I].
-Return clean CSV only (no fences)."""
-        try:
-            csv_text = call_openai_rows(MODEL, key, prompt)
-            df = pd.read_csv(io.StringIO(csv_text))
-            df = align_to_tasks(df, tasks)
-            st.session_state["raci"] = df
-        except Exception as e:
-            st.error(f"CSV parsing failed: {e}")
-    show_table_with_download("raci", raci_cols, "raci.csv")
-
-# Controls
-with tabs[3]:
-    st.markdown("Generate **Controls** mapped to tasks (SOX/ISO/etc.).")
-    ctrl_cols = ["element_id","element_name","control_name","control_type","frequency","evidence_required","owner"]
-    if st.button("Generate Controls"):
-        key = require_key()
-        prompt = f"""Generate a CSV table for control mappings per task.
-
-Use exactly these task identifiers and names (do not invent or renumber):
-element_id,element_name
-{mapping_lines}
+Return clean CSV only (no fences).""",
+    "controls": f"""Generate a CSV table for control mappings per task.
 
 Columns (in this exact order):
 {", ".join(ctrl_cols)}
 - control_type: Preventive/Detective/Corrective
 - frequency: per_txn, daily, weekly, monthly
-Return clean CSV only (no code fences)."""
+Return clean CSV only (no code fences).""",
+}
+
+def store_table(state_key: str, df: pd.DataFrame):
+    # Align, score, fix the column order and encode the download once, when a
+    # table is generated, so rendering it on later reruns is just a lookup.
+    df = align_to_tasks(df, task_ids, task_names)  # ensures names match "Detected Tasks"
+    if df.empty:
+        # Nothing usable: keep whatever was stored before, and don't mark the
+        # table current, so the next click tries again.
+        raise ValueError("no rows matched the detected tasks")
+    if state_key == "risks":
+        df = add_risk_scores(df)
+    df = df.reindex(columns=display_cols[state_key])
+    st.session_state[state_key] = df
+    st.session_state[f"{state_key}_csv"] = df_to_csv_bytes(df)
+    st.session_state[f"{state_key}_sig"] = (MODEL, bpmn_digest)
+
+# A table stored for this upload and model is what a repeat click would produce
+# again, so such clicks skip the request (Force refresh overrides this).
+UP_TO_DATE = "already generated for this file; tick **Force refresh** to generate again."
+
+def is_current(state_key: str) -> bool:
+    return st.session_state.get(f"{state_key}_sig") == (MODEL, bpmn_digest)
+
+# Generate several tables at once, either in one round-trip (the task mapping
+# is sent once and the model returns the chosen tables as JSON rows under a
+# strict schema, so there is no CSV to tokenize) or as the matching per-tab
+# prompts issued concurrently.
+table_labels = {"kpis": "KPIs", "risks": "Risks", "raci": "RACI", "controls": "Controls"}
+batch_specs = {
+    "kpis": f'- "kpis" columns: {", ".join(kpi_cols)}. Use snake_case for kpi_key; current_value/target_value numeric or % where sensible; last_updated: YYYY-MM-DD.',
+    "risks": f'- "risks" columns: {", ".join(risk_cols)}.',
+    "raci": f'- "raci" columns: {", ".join(raci_cols)}. Create 1–3 rows per task, responsibility_type ∈ [R, A, C, I].',
+    "controls": f'- "controls" columns: {", ".join(ctrl_cols)}. control_type: Preventive/Detective/Corrective; frequency: per_txn, daily, weekly, monthly.',
+}
+selected = st.multiselect("Tables to generate together", list(table_labels), default=list(table_labels),
+                          format_func=table_labels.get)
+col_all, col_mode, col_refresh = st.columns([1, 3, 1], gap="small")
+with col_mode:
+    all_mode = st.radio("Generate All via", ["One batched request", "Parallel requests"],
+                        horizontal=True, label_visibility="collapsed")
+with col_refresh:
+    refresh_all = st.checkbox("Force refresh", key="refresh_all",
+                              help="Ignore cached responses and call OpenAI again.")
+with col_all:
+    gen_all = st.button("Generate selected", use_container_width=True, disabled=not (selected and task_ids))
+if gen_all:
+    pending = [k for k in selected if refresh_all or not is_current(k)]
+    skipped = [table_labels[k] for k in selected if k not in pending]
+    if skipped:
+        st.caption(f"{', '.join(skipped)}: {UP_TO_DATE}")
+if gen_all and pending:
+    key = require_key()
+    frames = {}
+    if all_mode == "Parallel requests":
+        with st.status(f"Generating {', '.join(table_labels[k] for k in pending)}…") as status:
+            results = call_openai_rows_parallel(MODEL, key, {k: prompts[k] for k in pending},
+                                                system=prompt_prefix, refresh=refresh_all,
+                                                on_done=lambda k: status.write(f"✓ {table_labels[k]}"),
+                                                accept=lambda k, t: store_table(k, read_csv_text(t, table_cols[k])))
+            status.update(label="Generation finished", state="complete")
+        for _key, result in results.items():
+            if isinstance(result, Exception):
+                st.error(f"{_key}: generation failed: {result}")
+    else:
+        keys_list = ", ".join(f'"{k}"' for k in pending)
+        specs = "\n".join(batch_specs[k] for k in pending)
+        prompt = f"""You are a BPM analyst producing {", ".join(table_labels[k] for k in pending)} tables.
+
+Return a JSON object with the keys {keys_list}.
+Each value is an array of row objects whose keys are that table's columns:
+{specs}"""
+        schema = {
+            "type": "object",
+            "properties": {k: rows_schema(table_cols[k]) for k in pending},
+            "required": list(pending),
+            "additionalProperties": False,
+        }
         try:
-            csv_text = call_openai_rows(MODEL, key, prompt)
-            df = pd.read_csv(io.StringIO(csv_text))
-            df = align_to_tasks(df, tasks)  # ensures names match "Detected Tasks"
-            st.session_state["controls"] = df
+            payload = call_openai_json(MODEL, key, prompt, schema=schema, system=prompt_prefix,
+                                       refresh=refresh_all)
+            frames = {k: pd.DataFrame.from_records(payload[k], columns=table_cols[k]) for k in pending}
+        except Exception as e:
+            st.error(f"Generation failed: {e}")
+    for _key, df in frames.items():
+        try:
+            store_table(_key, df)
+        except ValueError as e:
+            st.error(f"{_key}: {e}")
+
+# Background mode: queue the selected per-tab prompts as an OpenAI batch and
+# pick the results up later (the batch id is kept in session state).
+col_batch, col_check, col_batch_status = st.columns([1, 1, 3], gap="small")
+with col_batch:
+    queue_batch = st.button("Queue as batch", use_container_width=True, disabled=not (selected and task_ids),
+                            help="OpenAI Batch API: 50% cheaper, results within 24h.")
+with col_check:
+    check_batch = st.button("Check batch status", use_container_width=True)
+if queue_batch:
+    key = require_key()
+    try:
+        batch_id = submit_batch(MODEL, key, {k: prompts[k] for k in selected}, system=prompt_prefix)
+        st.session_state["batch"] = {"id": batch_id, "digest": bpmn_digest, "tables": list(selected)}
+    except Exception as e:
+        st.error(f"Batch submission failed: {e}")
+batch = st.session_state.get("batch")
+if check_batch and batch is None:
+    st.info("No batch is queued for this session.")
+elif check_batch:
+    key = require_key()
+    try:
+        status, results = fetch_batch(key, batch["id"], batch["tables"])
+    except Exception as e:
+        st.error(f"Batch lookup failed: {e}")
+        status, results = None, {}
+    if status is not None:
+        batch["status"] = status
+    if status in BATCH_DONE and batch["digest"] != bpmn_digest:
+        # Keep the batch: its results load once the original file is back.
+        st.warning("This batch was queued for a different BPMN file; load that file again and "
+                   "check the batch status to import its results.")
+        status, results = None, {}
+    for _key, csv_text in results.items():
+        if isinstance(csv_text, Exception):
+            st.error(f"{_key}: generation failed: {csv_text}")
+            continue
+        try:
+            store_table(_key, read_csv_text(csv_text, table_cols[_key]))
+        except Exception as e:
+            st.error(f"{_key}: CSV parsing failed: {e}")
+    if status in BATCH_DONE:
+        if status != "completed":
+            st.error(f"Batch {status}; queue it again to retry.")
+        st.session_state["batch"] = None
+if batch is not None:
+    with col_batch_status:
+        st.caption(f"Batch `{batch['id']}`: {batch.get('status', 'submitted')}")
+
+# Each tab is a fragment, so its button only reruns that tab: the parse, the
+# diagram iframe and the other tabs stay as they are.
+@st.fragment
+def generator_tab(state_key: str, intro: str):
+    label = table_labels[state_key]
+    st.markdown(intro)
+    refresh = st.checkbox("Force refresh", key=f"refresh_{state_key}",
+                          help="Ignore the cached response and call OpenAI again.")
+    clicked = st.button(f"Generate {label}", disabled=not task_ids)
+    if clicked and is_current(state_key) and not refresh:
+        st.caption(f"{label}: {UP_TO_DATE}")
+    elif clicked:
+        key = require_key()
+        try:
+            call_openai_rows(MODEL, key, prompts[state_key], preview=st.empty(), system=prompt_prefix,
+                             refresh=refresh,
+                             accept=lambda t: store_table(state_key, read_csv_text(t, table_cols[state_key])))
         except Exception as e:
             st.error(f"CSV parsing failed: {e}")
-    show_table_with_download("controls", ctrl_cols, "controls.csv")
-
-
-
-
-
-
-
-
-
+    show_table_with_download(state_key, display_cols[state_key], f"{state_key}.csv")
+
+
+tab_intros = {
+    "kpis": "Generate **KPI** rows for each task.",
+    "risks": "Generate **Risk Register** rows linked to tasks.",
+    "raci": "Generate **RACI** matrix entries per task.",
+    "controls": "Generate **Controls** mapped to tasks (SOX/ISO/etc.).",
+}
+for tab, (_key, intro) in zip(st.tabs([table_labels[k] for k in tab_intros]), tab_intros.items()):
+    with tab:
+        generator_tab(_key, intro)